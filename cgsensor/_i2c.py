@@ -0,0 +1,35 @@
+"""
+センサー制御クラスで共有するI2Cバス
+Indoor Corgi, https://www.indoorcorgielec.com
+GitHub: https://github.com/IndoorCorgi/cgsensor
+"""
+
+import smbus2
+
+_buses = {}  # 開いたI2Cバス. {バス番号: SMBus}
+
+
+def get_bus(num):
+  """
+  指定した番号のI2Cバスを返す. 最初の呼び出し時にのみ開き, 以降は同じSMBusを返す.
+  smbus2はスレッドセーフではないため, 複数のスレッドから使う場合は呼び出し側で排他制御が必要.
+
+  Args:
+    num: I2Cバス番号. /dev/i2c-<num>を開く.
+
+  Returns:
+    smbus2.SMBus: I2Cバス
+  """
+  if num not in _buses:
+    _buses[num] = smbus2.SMBus(num)
+  return _buses[num]
+
+
+def close():
+  """
+  開いている全てのI2Cバスを閉じる.
+  閉じる前に作成したセンサー制御クラスのインスタンスは使えなくなるので, 作り直す必要がある.
+  """
+  for bus in _buses.values():
+    bus.close()
+  _buses.clear()
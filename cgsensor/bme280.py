@@ -5,7 +5,16 @@ GitHub: https://github.com/IndoorCorgi/cgsensor
 """
 
 import time
+import struct
+from collections import namedtuple
 import smbus2
+from ._i2c import get_bus
+
+# キャリブレーションレジスターの値. フィールド名はデータシートに合わせている.
+CalibrationData = namedtuple('CalibrationData', [
+    'dig_T1', 'dig_T2', 'dig_T3', 'dig_P1', 'dig_P2', 'dig_P3', 'dig_P4', 'dig_P5', 'dig_P6', 'dig_P7', 'dig_P8',
+    'dig_P9', 'dig_H1', 'dig_H2', 'dig_H3', 'dig_H4', 'dig_H5', 'dig_H6'
+])
 
 
 class BME280:
@@ -14,6 +23,7 @@ class BME280:
 
   Attributes:
     calibration_data (dict): センサーから読み出したキャリブレーション名, 値の辞書
+    cal (CalibrationData): calibration_dataと同じ値. 計算ではこちらを使う.
     t_fine : キャリブレーション計算途中のパラメータ
     adc_temperature: ADCレジスターの読み出し値(温度)
     adc_pressure: ADCレジスターの読み出し値(気圧)
@@ -57,9 +67,14 @@ class BME280:
       i2c_addr: センサーのI2Cアドレス. 7bit. 
     """
     self.i2c_addr = i2c_addr
-    self.bus = smbus2.SMBus(1)
+    self.bus = get_bus(1)
 
     self.calibration_data = {}
+    self.cal = None
+    self._T1_s1 = 0
+    self._P4_s35 = 0
+    self._P7_s4 = 0
+    self._calibration_loaded = False
     self.t_fine = 0
 
     self.adc_temperature = 0
@@ -81,7 +96,11 @@ class BME280:
     Returns:
       list: 読み出しデータのリスト
     """
-    return self.bus.read_i2c_block_data(self.i2c_addr, addr, length)
+    # アドレス書き込みと読み出しをリピーテッドスタートで1回の転送にまとめる
+    msg_write = smbus2.i2c_msg.write(self.i2c_addr, [addr])
+    msg_read = smbus2.i2c_msg.read(self.i2c_addr, length)
+    self.bus.i2c_rdwr(msg_write, msg_read)
+    return list(msg_read)
 
   def read_register_word(self, addr):
     """
@@ -94,7 +113,7 @@ class BME280:
     Returns:
       int: 読み出した16bitのデータ
     """
-    data = self.bus.read_i2c_block_data(self.i2c_addr, addr, 2)
+    data = self.read_register(addr, 2)
     return data[0] + (data[1] << 8)
 
   def write_register(self, addr, data):
@@ -107,6 +126,19 @@ class BME280:
     """
     self.bus.write_i2c_block_data(self.i2c_addr, addr, data)
 
+  def write_registers(self, data):
+    """
+    I2Cで複数のレジスターに1回の転送で書き込む.
+    書き込み時はアドレスが自動で進まないため, アドレスとデータの組を並べて送る.
+
+    Args:
+      data(list): (書き込みアドレス, 書き込みデータ)のリスト. 先頭から順に書き込まれる.
+    """
+    write_data = []
+    for addr, value in data:
+      write_data.extend([addr, value])
+    self.bus.i2c_rdwr(smbus2.i2c_msg.write(self.i2c_addr, write_data))
+
   def check_id(self):
     """
     センサーからIDを読み出して期待値と一致するか確認
@@ -135,37 +167,36 @@ class BME280:
 
   def read_calibration_data(self):
     """
-    センサーからキャリブレーションレジスターの値を読み出し, calibration_dataに入れる.
-    """
-    self.calibration_data['dig_T1'] = self.read_register_word(0x88)
-    self.calibration_data['dig_T2'] = self._get_signed16(self.read_register_word(0x8A))
-    self.calibration_data['dig_T3'] = self._get_signed16(self.read_register_word(0x8C))
-    self.calibration_data['dig_P1'] = self.read_register_word(0x8E)
-    self.calibration_data['dig_P2'] = self._get_signed16(self.read_register_word(0x90))
-    self.calibration_data['dig_P3'] = self._get_signed16(self.read_register_word(0x92))
-    self.calibration_data['dig_P4'] = self._get_signed16(self.read_register_word(0x94))
-    self.calibration_data['dig_P5'] = self._get_signed16(self.read_register_word(0x96))
-    self.calibration_data['dig_P6'] = self._get_signed16(self.read_register_word(0x98))
-    self.calibration_data['dig_P7'] = self._get_signed16(self.read_register_word(0x9A))
-    self.calibration_data['dig_P8'] = self._get_signed16(self.read_register_word(0x9C))
-    self.calibration_data['dig_P9'] = self._get_signed16(self.read_register_word(0x9E))
-    self.calibration_data['dig_H1'] = self.read_register(0xA1, 1)[0]
-    self.calibration_data['dig_H2'] = self._get_signed16(self.read_register_word(0xE1))
-    self.calibration_data['dig_H3'] = self.read_register(0xE3, 1)[0]
-    self.calibration_data['dig_H4'] = self._get_signed16((self.read_register(0xE4, 1)[0] << 4) +
-                                                         (self.read_register(0xE5, 1)[0] & 0xF))
-    self.calibration_data['dig_H5'] = self._get_signed16(self.read_register_word(0xE5) >> 4)
-    self.calibration_data['dig_H6'] = self._get_signed8(self.read_register(0xE7, 1)[0])
+    センサーからキャリブレーションレジスターの値を読み出し, cal, calibration_dataに入れる.
+    """
+    # 0x88-0xA1, 0xE1-0xE7の連続したレジスターをそれぞれ1回で読み出す
+    data = bytes(self.read_register(0x88, 26))
+    dig_t_p_h1 = struct.unpack('<HhhHhhhhhhhhxB', data)  # dig_T1-dig_P9, dig_H1
+
+    data = bytes(self.read_register(0xE1, 7))
+    dig_H2, dig_H3 = struct.unpack_from('<hB', data, 0)
+    dig_H4 = (data[3] << 4) + (data[4] & 0xF)
+    dig_H5 = ((data[5] << 8) + data[4]) >> 4
+    dig_H6 = struct.unpack_from('<b', data, 6)[0]
+
+    self.cal = CalibrationData(*dig_t_p_h1, dig_H2, dig_H3, dig_H4, dig_H5, dig_H6)
+    self.calibration_data = dict(self.cal._asdict())
+
+    # 測定ごとに変わらないシフト演算は先に計算しておく
+    self._T1_s1 = self.cal.dig_T1 << 1
+    self._P4_s35 = self.cal.dig_P4 << 35
+    self._P7_s4 = self.cal.dig_P7 << 4
 
   def read_adc(self):
     """
     ADCレジスターの値を読み出してadc_temperature, adc_pressure, adc_humidityに入れる
     """
-    data = self.read_register(0xF7, 8)
+    data = bytes(self.read_register(0xF7, 8))
 
-    self.adc_pressure = (data[0] << 12) + (data[1] << 4) + (data[2] >> 4)
-    self.adc_temperature = (data[3] << 12) + (data[4] << 4) + (data[5] >> 4)
-    self.adc_humidity = (data[6] << 8) + data[7]
+    # 気圧, 温度は20bit(下位4bitは未使用), 湿度は16bitのビッグエンディアン
+    self.adc_pressure = int.from_bytes(data[0:3], 'big') >> 4
+    self.adc_temperature = int.from_bytes(data[3:6], 'big') >> 4
+    self.adc_humidity = int.from_bytes(data[6:8], 'big')
 
   def write_config(self, t_standby=T_STANDBY_05MS, filter=FILTER_OFF):
     """
@@ -192,44 +223,171 @@ class BME280:
       os_pressure: 気圧のオーバーサンプリング. OVER_SAMPLING_xで指定.
       os_humidity: 湿度のオーバーサンプリング. OVER_SAMPLING_xで指定.
     """
-    data = os_humidity
-    self.write_register(0xF2, [data])  # ctrl_humレジスター
+    # ctrl_humの変更はctrl_measを書き込んだ時に反映されるので, この順で書き込む
+    self.write_registers([
+        (0xF2, os_humidity),  # ctrl_humレジスター
+        (0xF4, (os_temperature << 5) | (os_pressure << 2) | mode),  # ctrl_measレジスター
+    ])
+
+  def write_config_ctrl(self,
+                        mode=MODE_SLEEP,
+                        os_temperature=OVER_SAMPLING_1,
+                        os_pressure=OVER_SAMPLING_1,
+                        os_humidity=OVER_SAMPLING_1,
+                        t_standby=T_STANDBY_05MS,
+                        filter=FILTER_OFF):
+    """
+    write_config, write_ctrlと同じ内容を1回の転送で書き込む.
+    configはctrl_measで測定が始まる前に書き込まれる.
 
-    data = (os_temperature << 5) | (os_pressure << 2) | mode
-    self.write_register(0xF4, [data])  # ctrl_measレジスター
+    Args:
+      mode: センサーモード. MODE_xで指定. FORCED, NORMALを書くと測定が始まる 
+      os_temperature: 温度のオーバーサンプリング. OVER_SAMPLING_xで指定.
+      os_pressure: 気圧のオーバーサンプリング. OVER_SAMPLING_xで指定.
+      os_humidity: 湿度のオーバーサンプリング. OVER_SAMPLING_xで指定.
+      t_standby: Normal mode測定間隔. T_STANDBY_xで指定. 
+      filter: 測定値の平滑化を行うかどうか. FILTER_xで指定.
+    """
+    self.write_registers([
+        (0xF2, os_humidity),  # ctrl_humレジスター
+        (0xF5, (t_standby << 5) | (filter << 2)),  # ctrl_configレジスター
+        (0xF4, (os_temperature << 5) | (os_pressure << 2) | mode),  # ctrl_measレジスター
+    ])
 
   def write_reset(self):
     """
     リセットレジスターに書き込んでソフトウェアリセットする
     """
     self.write_register(0xE0, [0xB6])  # resetレジスター
+    self._calibration_loaded = False  # リセット後はキャリブレーションデータを読み直す
+
+  def calculate_measurement_time(self,
+                                 os_temperature=OVER_SAMPLING_1,
+                                 os_pressure=OVER_SAMPLING_1,
+                                 os_humidity=OVER_SAMPLING_1):
+    """
+    オーバーサンプリング設定から1回の測定にかかる最大時間をデータシートの式で計算する
 
-  def forced(self):
+    Args:
+      os_temperature: 温度のオーバーサンプリング. OVER_SAMPLING_xで指定. 0で測定なし.
+      os_pressure: 気圧のオーバーサンプリング. OVER_SAMPLING_xで指定. 0で測定なし.
+      os_humidity: 湿度のオーバーサンプリング. OVER_SAMPLING_xで指定. 0で測定なし.
+
+    Returns:
+      float: 最大測定時間[s]
+    """
+    t = 1.25  # [ms]
+    if os_temperature:
+      t += 2.3 * (1 << (os_temperature - 1))
+    if os_pressure:
+      t += 2.3 * (1 << (os_pressure - 1)) + 0.575
+    if os_humidity:
+      t += 2.3 * (1 << (os_humidity - 1)) + 0.575
+    return t / 1000
+
+  def forced(self, skip_id_check=False):
     """
     Forcedモードで測定を行い, 結果をtemperature, pressure, humidityに入れる
+
+    Args:
+      skip_id_check: TrueならIDチェックを省略する. check_idで確認済みの場合に使う.
     
     Returns:
       bool: 成功でTrue, IDチェック失敗でFalse
     """
     # IDチェック
-    if not self.check_id():
+    if not skip_id_check and not self.check_id():
+      return False
+
+    self.write_config_ctrl(mode=self.MODE_FORCED,
+                           os_temperature=self.OVER_SAMPLING_16,
+                           os_pressure=self.OVER_SAMPLING_16,
+                           os_humidity=self.OVER_SAMPLING_16)
+    self._read_forced()
+    return True
+
+  def prepare(self, skip_id_check=False):
+    """
+    繰り返し測定する場合の準備. IDチェック, キャリブレーションデータ読み出し, configの書き込みを1度だけ行う.
+    以降はsampleで測定できる.
+
+    Args:
+      skip_id_check: TrueならIDチェックを省略する. check_idで確認済みの場合に使う.
+
+    Returns:
+      bool: 成功でTrue, IDチェック失敗でFalse
+    """
+    if not skip_id_check and not self.check_id():
       return False
 
+    self.read_calibration_data()
+    self._calibration_loaded = True
     self.write_config()
+    return True
+
+  def sample(self):
+    """
+    Forcedモードで測定を行い, 結果をtemperature, pressure, humidityに入れる.
+    前もってprepareの実行が必要. ctrlの書き込みと結果の読み出しのみ行う.
+    """
     self.write_ctrl(mode=self.MODE_FORCED,
                     os_temperature=self.OVER_SAMPLING_16,
                     os_pressure=self.OVER_SAMPLING_16,
                     os_humidity=self.OVER_SAMPLING_16)
-    time.sleep(0.01)
+    self._read_forced()
 
-    self.read_measured_values()
-    return True
+  def _read_forced(self):
+    """
+    forced, sampleで開始した測定の完了を待って結果を読み出す
+    """
+    # 最大測定時間に1割のマージンを加えて待機すればステータスを確認せずに読み出せる
+    time.sleep(
+        self.calculate_measurement_time(os_temperature=self.OVER_SAMPLING_16,
+                                        os_pressure=self.OVER_SAMPLING_16,
+                                        os_humidity=self.OVER_SAMPLING_16) * 1.1)
 
-  def read_measured_values(self):
+    self.read_measured_values(wait=False)
+
+  def start_normal(self,
+                   t_standby=T_STANDBY_1000MS,
+                   filter=FILTER_OFF,
+                   os_temperature=OVER_SAMPLING_16,
+                   os_pressure=OVER_SAMPLING_16,
+                   os_humidity=OVER_SAMPLING_16):
     """
-    キャリブレーションデータとADCレジスターを読み出し, 結果をtemperature, pressure, humidityに入れる
+    Normalモードで定期測定を開始し, 最初の測定完了まで待機する. 以降はread_normalで結果を読み出す.
+
+    Args:
+      t_standby: 測定間隔. T_STANDBY_xで指定.
+      filter: 測定値の平滑化を行うかどうか. FILTER_xで指定.
+      os_temperature: 温度のオーバーサンプリング. OVER_SAMPLING_xで指定.
+      os_pressure: 気圧のオーバーサンプリング. OVER_SAMPLING_xで指定.
+      os_humidity: 湿度のオーバーサンプリング. OVER_SAMPLING_xで指定.
+    """
+    # Normalモード中はconfigの書き込みが無視されることがあるので, 一度Sleepモードにする
+    self.write_ctrl(mode=self.MODE_SLEEP)
+    self.write_config_ctrl(mode=self.MODE_NORMAL,
+                           os_temperature=os_temperature,
+                           os_pressure=os_pressure,
+                           os_humidity=os_humidity,
+                           t_standby=t_standby,
+                           filter=filter)
+    time.sleep(
+        self.calculate_measurement_time(os_temperature=os_temperature,
+                                        os_pressure=os_pressure,
+                                        os_humidity=os_humidity) * 1.1)
+
+  def read_normal(self):
+    """
+    Normalモードの最新の測定結果を読み出し, temperature, pressure, humidityに入れる.
+    前もってstart_normalの実行が必要.
+    """
+    self.read_measured_values(wait=False)
+
+  def wait_measurement(self):
+    """
+    測定中の場合は完了まで待機する
     """
-    # 測定中の場合は完了まで待機
     while True:
       measuring, im_update = self.read_status()
       if 0 == measuring:  # 測定完了
@@ -237,9 +395,27 @@ class BME280:
 
       time.sleep(0.001)
 
-    self.read_calibration_data()  # キャリブレーションデータ読み出し
+  def read_measured_values(self, wait=True):
+    """
+    キャリブレーションデータとADCレジスターを読み出し, 結果をtemperature, pressure, humidityに入れる
+
+    Args:
+      wait: Trueなら読み出し前に測定完了を待つ. Falseならすぐに読み出し, 測定値が無い場合のみ待つ.
+    """
+    if wait:
+      self.wait_measurement()
+
+    # キャリブレーションデータは書き換わらないので初回のみ読み出す
+    if not self._calibration_loaded:
+      self.read_calibration_data()
+      self._calibration_loaded = True
     self.read_adc()  # ADCレジスター読み出し
 
+    # リセット直後などで測定値が無い場合は測定完了を待って読み直す
+    if not wait and 0x80000 == self.adc_temperature:
+      self.wait_measurement()
+      self.read_adc()
+
     # キャリブレーション計算
     self.compensate_temperature()
     self.compensate_pressure()
@@ -247,85 +423,106 @@ class BME280:
 
   def compensate_temperature(self):
     """
-    calibration_dataとadc_temperatureの値から気圧を計算し, temperatureに入れる
+    calとadc_temperatureの値から気圧を計算し, temperatureに入れる
     有効な測定値が無い場合はtemperatureに0が入る
     """
+    adc = self.adc_temperature
+
     # 測定値なし
-    if 0x80000 == self.adc_temperature:
+    if 0x80000 == adc:
       self.temperature = 0
       return
 
-    var1 = ((((self.adc_temperature >> 3) - (self.calibration_data['dig_T1'] << 1))) *
-            (self.calibration_data['dig_T2'])) >> 11
-    var2 = (((((self.adc_temperature >> 4) - (self.calibration_data['dig_T1'])) *
-              ((self.adc_temperature >> 4) - (self.calibration_data['dig_T1']))) >> 12) *
-            (self.calibration_data['dig_T3'])) >> 14
-    self.t_fine = var1 + var2
+    c = self.cal
+    self.t_fine = _compensate_t(adc, c.dig_T1, c.dig_T2, c.dig_T3, self._T1_s1)
     self.temperature = round(((self.t_fine * 5 + 128) >> 8) / 100, 1)
 
   def compensate_pressure(self):
     """
-    calibration_dataとadc_pressureの値から気圧を計算し, pressureに入れる
+    calとadc_pressureの値から気圧を計算し, pressureに入れる
     compensate_temperatureで計算したt_fineの値を利用するので前もって実行が必要
     有効な測定値が無い場合はpressureに0が入る
     """
+    adc = self.adc_pressure
+
     # 測定値なし
-    if 0x80000 == self.adc_pressure:
+    if 0x80000 == adc:
       self.pressure = 0
       return
 
-    var1 = self.t_fine - 128000
-    var2 = var1 * var1 * self.calibration_data['dig_P6']
-    var2 = var2 + ((var1 * self.calibration_data['dig_P5']) << 17)
-    var2 = var2 + (self.calibration_data['dig_P4'] << 35)
-    var1 = ((var1 * var1 * self.calibration_data['dig_P3']) >> 8) + ((var1 * self.calibration_data['dig_P2']) << 12)
-    var1 = (((1 << 47) + var1)) * (self.calibration_data['dig_P1']) >> 33
-    if var1 == 0:
+    c = self.cal
+    p = _compensate_p(adc, self.t_fine, c.dig_P1, c.dig_P2, c.dig_P3, self._P4_s35, c.dig_P5, c.dig_P6, self._P7_s4,
+                      c.dig_P8, c.dig_P9)
+    if p is None:
       return
-
-    p = 1048576 - self.adc_pressure
-    p = (((p << 31) - var2) * 3125) // var1
-    var1 = (self.calibration_data['dig_P9'] * (p >> 13) * (p >> 13)) >> 25
-    var2 = (self.calibration_data['dig_P8'] * p) >> 19
-    p = ((p + var1 + var2) >> 8) + ((self.calibration_data['dig_P7']) << 4)
     self.pressure = round(p / 25600, 1)
 
   def compensate_humidity(self):
     """
-    calibration_dataとadc_humidityの値から気圧を計算し, humidityに入れる
+    calとadc_humidityの値から気圧を計算し, humidityに入れる
     compensate_temperatureで計算したt_fineの値を利用するので前もって実行が必要
     有効な測定値が無い場合はhumidityに0が入る
     """
+    adc = self.adc_humidity
+
     # 測定値なし
-    if 0x8000 == self.adc_humidity:
+    if 0x8000 == adc:
       self.humidity = 0
       return
 
-    v_x1_u32r = (self.t_fine - 76800)
-    v_x1_u32r = (((((self.adc_humidity << 14) - ((self.calibration_data['dig_H4']) << 20) -
-                    ((self.calibration_data['dig_H5']) * v_x1_u32r)) + 16384) >> 15) *
-                 (((((((v_x1_u32r * self.calibration_data['dig_H6']) >> 10) *
-                      (((v_x1_u32r * self.calibration_data['dig_H3']) >> 11) + 32768)) >> 10) + 2097152) *
-                   self.calibration_data['dig_H2'] + 8192) >> 14))
-    v_x1_u32r = (v_x1_u32r - (((((v_x1_u32r >> 15) * (v_x1_u32r >> 15)) >> 7) * self.calibration_data['dig_H1']) >> 4))
-    if v_x1_u32r < 0:
-      v_x1_u32r = 0
-    if v_x1_u32r > 419430400:
-      v_x1_u32r = 419430400
-    self.humidity = round((v_x1_u32r >> 12) / 1024, 1)
+    c = self.cal
+    h = _compensate_h(adc, self.t_fine, c.dig_H1, c.dig_H2, c.dig_H3, c.dig_H4, c.dig_H5, c.dig_H6)
+    self.humidity = round(h / 1024, 1)
 
-  def _get_signed8(self, uint):
-    """
-    8bit unsigned intから8bit signed intを計算
-    """
-    if uint > 127:
-      return uint - 256
-    return uint
 
-  def _get_signed16(self, uint):
-    """
-    16bit unsigned intから16bit signed intを計算
-    """
-    if uint > 32767:
-      return uint - 65536
-    return uint
+def _compensate_t(adc, T1, T2, T3, T1_s1):
+  """
+  温度のADC値とキャリブレーション値からt_fineを計算. データシートの整数演算の式.
+  T1_s1はT1 << 1を前もって計算した値.
+
+  Returns:
+    int: t_fine. 温度[°C]は(t_fine * 5 + 128) >> 8で100倍の値になる.
+  """
+  var1 = (((adc >> 3) - T1_s1) * T2) >> 11
+  var2 = (((((adc >> 4) - T1) * ((adc >> 4) - T1)) >> 12) * T3) >> 14
+  return var1 + var2
+
+
+def _compensate_p(adc, t_fine, P1, P2, P3, P4_s35, P5, P6, P7_s4, P8, P9):
+  """
+  気圧のADC値, t_fine, キャリブレーション値から気圧を計算. データシートの整数演算の式.
+  P4_s35, P7_s4はP4 << 35, P7 << 4を前もって計算した値.
+
+  Returns:
+    int: 気圧[Pa]の256倍の値. 計算できない場合はNone.
+  """
+  var1 = t_fine - 128000
+  var2 = var1 * var1 * P6
+  var2 = var2 + ((var1 * P5) << 17)
+  var2 = var2 + P4_s35
+  var1 = ((var1 * var1 * P3) >> 8) + ((var1 * P2) << 12)
+  var1 = (((1 << 47) + var1)) * P1 >> 33
+  if var1 == 0:
+    return None
+
+  p = 1048576 - adc
+  p = (((p << 31) - var2) * 3125) // var1
+  var1 = (P9 * (p >> 13) * (p >> 13)) >> 25
+  var2 = (P8 * p) >> 19
+  return ((p + var1 + var2) >> 8) + P7_s4
+
+
+def _compensate_h(adc, t_fine, H1, H2, H3, H4, H5, H6):
+  """
+  湿度のADC値, t_fine, キャリブレーション値から湿度を計算. データシートの整数演算の式.
+
+  Returns:
+    int: 湿度[%]の1024倍の値
+  """
+  v_x1_u32r = (t_fine - 76800)
+  v_x1_u32r = (((((adc << 14) - (H4 << 20) - (H5 * v_x1_u32r)) + 16384) >> 15) *
+               (((((((v_x1_u32r * H6) >> 10) * (((v_x1_u32r * H3) >> 11) + 32768)) >> 10) + 2097152) *
+                 H2 + 8192) >> 14))
+  v_x1_u32r = (v_x1_u32r - (((((v_x1_u32r >> 15) * (v_x1_u32r >> 15)) >> 7) * H1) >> 4))
+  v_x1_u32r = max(0, min(v_x1_u32r, 419430400))  # 0-100%の範囲に制限
+  return v_x1_u32r >> 12
@@ -84,11 +84,12 @@ Options:
 
 import os
 import csv
-from datetime import datetime
+import time
 from docopt import docopt
 from .bme280 import *
 from .tsl2572 import *
 from .scd41 import *
+from ._i2c import get_bus
 
 
 def cli():
@@ -99,7 +100,7 @@ def cli():
 
   # I2Cバスを確認
   try:
-    smbus2.SMBus(1)
+    get_bus(1)
   except FileNotFoundError:
     print('I2Cバスが開けませんでした. I2Cが有効になっているか確認して下さい. ')
     return
@@ -108,34 +109,56 @@ def cli():
   # 全センサー
   if args['all']:
     # センサー制御クラス
-    bme280list = [BME280(0x76), BME280(0x77)]
+    # BME280はIDを確認できたアドレスのみ登録し, ループ内では再確認しない
+    bme280list = []
+    for i2c_addr in [0x76, 0x77]:
+      bme280 = BME280(i2c_addr)
+      try:
+        if bme280.check_id():
+          bme280list.append(bme280)
+      except IOError:
+        pass
+    bme280_prepared = set()  # prepareが成功したBME280
     tsl2572 = TSL2572()
     scd41 = SCD41()
 
     first_line = True
+    log_file = None  # -fで指定したファイル. 最初の書き込み時に開き, 終了まで閉じない
+    log_path = args['-f']
+    if log_path is not None:
+      log_dir = os.path.dirname(log_path)
+      log_exists = os.path.isfile(log_path)  # ファイルが既にあるか確認
 
     try:
       while True:
         # ログ用の値を保存するリスト
         log_header = ['時刻']
-        log_data = [datetime.now().strftime("%Y/%m/%d %H:%M:%S")]
+        log_data = [time.strftime("%Y/%m/%d %H:%M:%S")]
 
         # BME280センサーを検出したら測定する
         for bme280 in bme280list:
           try:
-            if bme280.forced():
-              if bme280.i2c_addr == 0x77:
-                sensor_title = 'BME280#2'
-              else:
-                sensor_title = 'BME280'
+            # 準備は最初に1度だけ行う. 失敗した場合は次の測定で再度行う.
+            if bme280 not in bme280_prepared:
+              bme280.prepare(skip_id_check=True)
+              bme280_prepared.add(bme280)
 
-              if not args['-c']:
-                print('{}'.format(sensor_title))
-                print('  温度[°C]:  {}'.format(bme280.temperature))
-                print('  湿度[%]:   {}'.format(bme280.humidity))
-                print('  気圧[hPa]: {}'.format(bme280.pressure))
-              log_header.extend([sensor_title + ' 温度[°C]', sensor_title + ' 湿度[%]', sensor_title + ' 気圧[hPa]'])
-              log_data.extend([bme280.temperature, bme280.humidity, bme280.pressure])
+            # 継続測定でも毎回Forcedモードで測定する. 測定の間はセンサーがSleepモードになり自己発熱を抑えられ,
+            # 途中でセンサーがリセットされても次の測定から復帰できる.
+            bme280.sample()
+
+            if bme280.i2c_addr == 0x77:
+              sensor_title = 'BME280#2'
+            else:
+              sensor_title = 'BME280'
+
+            if not args['-c']:
+              print('{}'.format(sensor_title))
+              print('  温度[°C]:  {}'.format(bme280.temperature))
+              print('  湿度[%]:   {}'.format(bme280.humidity))
+              print('  気圧[hPa]: {}'.format(bme280.pressure))
+            log_header.extend([sensor_title + ' 温度[°C]', sensor_title + ' 湿度[%]', sensor_title + ' 気圧[hPa]'])
+            log_data.extend([bme280.temperature, bme280.humidity, bme280.pressure])
           except IOError:
             continue
 
@@ -158,7 +181,7 @@ def cli():
           if not result:
             scd41.stop_periodic_measurement()
             scd41.start_periodic_measurement()
-            result = scd41.read_measurement(timeout=6)
+            result = scd41.read_measurement(timeout=6, initial_wait=4.8)  # 最初の測定は約5秒後
 
           # 測定結果が読み出せた場合
           if result:
@@ -182,17 +205,21 @@ def cli():
           return
 
         # ファイルに記録
-        if None != args['-f']:
-          log_exists = os.path.isfile(args['-f'])  # ファイルが既にあるか確認
-          if os.path.dirname(args['-f']) != '':
-            os.makedirs(os.path.dirname(args['-f']), exist_ok=True)  # 必要に応じてディレクトリ作成
-          with open(args['-f'], 'a') as f:
-            writer = csv.writer(f)
+        if log_path is not None:
+          if log_file is None:
+            if log_dir != '':
+              os.makedirs(log_dir, exist_ok=True)  # 必要に応じてディレクトリ作成
+            log_file = open(log_path, 'a')
+            writer = csv.writer(log_file)
             if not log_exists:
               writer.writerow(log_header)
-            writer.writerow(log_data)
-            if not args['-c']:
-              print('ファイル{}に書き込みました. '.format(args['-f']))
+          writer.writerow(log_data)
+
+          # 強制終了や電源断でも記録が残るように毎回ディスクに書き出す
+          log_file.flush()
+          os.fsync(log_file.fileno())
+          if not args['-c']:
+            print('ファイル{}に書き込みました. '.format(log_path))
 
         # 継続するかどうか
         if args['-c']:
@@ -211,6 +238,9 @@ def cli():
           return
     except KeyboardInterrupt:
       return
+    finally:
+      if log_file is not None:
+        log_file.close()
 
   #----------------------------
   # BME280
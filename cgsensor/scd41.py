@@ -5,7 +5,56 @@ GitHub: https://github.com/IndoorCorgi/cgsensor
 """
 
 import time
+import struct
 import smbus2
+from ._i2c import get_bus
+
+
+def _crc8_byte(crc):
+  """
+  CRC-8(多項式0x31)の1バイト分の計算. テーブル作成用.
+  """
+  for j in range(8):
+    if (crc & 0x80) == 0:
+      crc = (crc << 1) & 0xFF
+    else:
+      crc = ((crc << 1) ^ 0x31) & 0xFF
+  return crc
+
+
+def _round_q16(n):
+  """
+  n / 2**16を整数に丸める. round()と同じく, ちょうど0.5の場合は偶数にする.
+  """
+  q = n >> 16
+  r = n & 0xFFFF
+  if r > 0x8000 or (r == 0x8000 and q & 1):
+    q += 1
+  return q
+
+
+# CRC計算用テーブル. 1バイトごとの計算結果を前もって求めておく.
+_CRC8_TABLE = bytes(_crc8_byte(i) for i in range(256))
+
+# コマンド. 上位, 下位バイトの順に並べたもの.
+_CMD_START_PERIODIC_MEASUREMENT = b'\x21\xb1'  # 0x21b1
+_CMD_START_LOW_POWER_PERIODIC_MEASUREMENT = b'\x21\xac'  # 0x21ac
+_CMD_MEASURE_SINGLE_SHOT = b'\x21\x9d'  # 0x219d
+_CMD_STOP_PERIODIC_MEASUREMENT = b'\x3f\x86'  # 0x3f86
+_CMD_GET_DATA_READY_STATUS = b'\xe4\xb8'  # 0xe4b8
+_CMD_READ_MEASUREMENT = b'\xec\x05'  # 0xec05
+_CMD_SET_TEMPERATURE_OFFSET = b'\x24\x1d'  # 0x241d
+_CMD_GET_TEMPERATURE_OFFSET = b'\x23\x18'  # 0x2318
+_CMD_SET_SENSOR_ALTITUDE = b'\x24\x27'  # 0x2427
+_CMD_GET_SENSOR_ALTITUDE = b'\x23\x22'  # 0x2322
+_CMD_SET_AMBIENT_PRESSURE = b'\xe0\x00'  # 0xe000
+_CMD_PERFORM_FORCED_RECALIBRATION = b'\x36\x2f'  # 0x362f
+_CMD_SET_AUTOMATIC_SELF_CALIBRATION_ENABLED = b'\x24\x16'  # 0x2416
+_CMD_GET_AUTOMATIC_SELF_CALIBRATION_ENABLED = b'\x23\x13'  # 0x2313
+_CMD_PERSIST_SETTINGS = b'\x36\x15'  # 0x3615
+_CMD_PERFORM_FACTORY_RESET = b'\x36\x32'  # 0x3632
+_CMD_REINIT = b'\x36\x46'  # 0x3646
+_CMD_GET_SERIAL_NUMBER = b'\x36\x82'  # 0x3682
 
 
 class SCD41:
@@ -19,7 +68,7 @@ class SCD41:
   """
 
   def __init__(self):
-    self.bus = smbus2.SMBus(1)
+    self.bus = get_bus(1)
     self.i2c_addr = 0x62
 
     self.co2 = 0
@@ -31,33 +80,38 @@ class SCD41:
     I2Cでセンサーの指定アドレスからデータを読み出す
 
     Args:
-      addr: 読み出しアドレス. 16bit. 
+      addr: 読み出しアドレス. 16bitの整数, または_CMD_xのbytes.
       length: 読み出しデータの長さ. バイト数.
     
     Returns:
-      list: 読み出しデータのリスト
+      bytes: 読み出しデータ
     """
-    msg_write = smbus2.i2c_msg.write(self.i2c_addr, [addr >> 8, addr & 0xFF])
+    if isinstance(addr, int):
+      addr = bytes([addr >> 8, addr & 0xFF])
+
+    msg_write = smbus2.i2c_msg.write(self.i2c_addr, addr)
     msg_read = smbus2.i2c_msg.read(self.i2c_addr, length)
     self.bus.i2c_rdwr(msg_write, msg_read)
-    return list(msg_read)
+    return msg_read.buf[:msg_read.len]
 
   def write_register(self, addr, data=None):
     """
     I2Cでセンサーの指定アドレスにデータを書き込む
 
     Args:
-      addr: 書き込みアドレス. 8bit. 
+      addr: 書き込みアドレス. 16bitの整数, または_CMD_xのbytes.
       data(list): 書き込みデータのリスト. 省略したらアドレスのみ書き込む(コマンド).
-    
-    Returns:
-      int: 読み出した16bitのデータ
     """
-    write_data = [addr >> 8, addr & 0xFF]
+    if isinstance(addr, int):
+      addr = bytes([addr >> 8, addr & 0xFF])
+
+    write_data = addr
     if data != None:
-      for b in data:
-        write_data.append(b)
-      write_data.append(self.calculate_crc(data))
+      # アドレス, データ, CRCを1つのバッファに直接書き込む
+      write_data = bytearray(len(data) + 3)
+      write_data[0:2] = addr
+      write_data[2:-1] = data
+      write_data[-1] = self.calculate_crc(data)
 
     msg_write = smbus2.i2c_msg.write(self.i2c_addr, write_data)
     self.bus.i2c_rdwr(msg_write)
@@ -72,17 +126,52 @@ class SCD41:
     Returns:
       int: CRC計算結果
     """
+    # SCD41のデータは全て2バイト単位なので, 2バイトならループ無しで計算
+    if len(data) == 2:
+      return self.calculate_crc_pair(data[0], data[1])
+
     crc = 0xFF
-    for i in range(len(data)):
-      crc ^= data[i]
-      for j in range(8):
-        if (crc & 0x80) == 0:
-          crc = (crc << 1) & 0xFF
-        else:
-          crc = ((crc << 1) ^ 0x31) & 0xFF
+    for b in data:
+      crc = _CRC8_TABLE[crc ^ b]
 
     return crc
 
+  def calculate_crc_pair(self, b0, b1):
+    """
+    2バイトのデータのCRCを計算. calculate_crcと同じ結果をループ無しで求める.
+
+    Args:
+      b0: 1バイト目
+      b1: 2バイト目
+
+    Returns:
+      int: CRC計算結果
+    """
+    return _CRC8_TABLE[_CRC8_TABLE[0xFF ^ b0] ^ b1]
+
+  def _read_words(self, addr, nwords):
+    """
+    指定アドレスから16bitのワードを読み出す. ワードごとにCRCを確認してから値に変換する.
+
+    Args:
+      addr: 読み出しアドレス. 16bitの整数, または_CMD_xのbytes.
+      nwords: 読み出すワード数
+
+    Returns:
+      tuple: ワードの値(int)のタプル
+
+    Raises:
+      CRCMismatchError: CRCが一致しない
+    """
+    data = self.read_register(addr, 3 * nwords)
+
+    # CRC確認. 各ワードは[上位, 下位, CRC]の3バイト.
+    for i in range(0, 3 * nwords, 3):
+      if self.calculate_crc_pair(data[i], data[i + 1]) != data[i + 2]:
+        raise CRCMismatchError
+
+    return struct.unpack_from('>' + 'Hx' * nwords, data)
+
   def start_periodic_measurement(self):
     """
     5秒おきの定期測定を開始. 測定中は使用できるコマンドが以下に制限される. データシート参照.
@@ -91,7 +180,7 @@ class SCD41:
     - set_ambient_pressure
     - get_data_ready_status
     """
-    self.write_register(0x21b1)
+    self.write_register(_CMD_START_PERIODIC_MEASUREMENT)
 
   def start_low_power_periodic_measurement(self):
     """
@@ -101,7 +190,7 @@ class SCD41:
     - set_ambient_pressure
     - get_data_ready_status
     """
-    self.write_register(0x21ac)
+    self.write_register(_CMD_START_LOW_POWER_PERIODIC_MEASUREMENT)
 
   def measure_single_shot(self, timeout=10):
     """
@@ -113,8 +202,8 @@ class SCD41:
     Returns:
       bool: 成功でTrue, タイムアウトでFalse. Trueの場合はco2, temperature, humidityの値が更新される
     """
-    self.write_register(0x219d)
-    return self.read_measurement(timeout)
+    self.write_register(_CMD_MEASURE_SINGLE_SHOT)
+    return self.read_measurement(timeout, initial_wait=4.9)  # 完了直前まではデータ確認をしない
 
   def stop_periodic_measurement(self, wait=True):
     """
@@ -123,7 +212,7 @@ class SCD41:
     Args:
       wait: Trueなら停止までの500ms以上待機する. Falseならすぐに処理を返す.
     """
-    self.write_register(0x3f86)
+    self.write_register(_CMD_STOP_PERIODIC_MEASUREMENT)
     if wait:
       time.sleep(0.6)
 
@@ -137,35 +226,66 @@ class SCD41:
     Raises:
       CRCMismatchError: CRCが一致しない
     """
-    data = self.read_register(0xe4b8, 3)
-
-    # CRC確認
-    if self.calculate_crc([data[0], data[1]]) != data[2]:
-      raise CRCMismatchError
-
-    if (data[1] & 0x3) == 0:
+    status, = self._read_words(_CMD_GET_DATA_READY_STATUS, 1)
+    if (status & 0x3) == 0:
       return False
     return True
 
-  def read_measurement(self, timeout=0):
+  def read_measurement(self, timeout=0, initial_wait=0):
     """
     測定データを読み出す. 成功した場合はco2, temperature, humidityの値が更新される
 
     Args:
       timeout: 新しい測定データを待つ秒数. 0だと待たずに処理を返す.
+      initial_wait: 最初にデータを確認するまで待機する秒数. timeoutに含まれる. 
+                    測定完了までの時間が分かっている場合に指定すると, 無駄なデータ確認を減らせる.
     
     Returns:
       bool: 成功でTrue, タイムアウトでFalse
     
     Raises:
-      ValueError: タイムアウトの値が範囲外
+      ValueError: タイムアウト, 待機時間の値が範囲外
       CRCMismatchError: CRCが一致しない
     """
+    steps = self._read_measurement_steps(timeout, initial_wait)
+    try:
+      while True:
+        time.sleep(next(steps))
+    except StopIteration as e:
+      return e.value
+
+  async def aread_measurement(self, timeout=0, initial_wait=0):
+    """
+    read_measurementの非同期版. 測定データを待つ間はasyncio.sleepで他の処理に制御を渡す.
+    引数, 戻り値, 例外はread_measurementと同じ.
+    """
+    import asyncio  # 非同期版を使う場合のみ読み込む
+
+    steps = self._read_measurement_steps(timeout, initial_wait)
+    try:
+      while True:
+        await asyncio.sleep(next(steps))
+    except StopIteration as e:
+      return e.value
+
+  def _read_measurement_steps(self, timeout, initial_wait):
+    """
+    read_measurementの処理本体. 待機が必要な箇所で待機する秒数をyieldし, 結果をreturnする.
+    同期版, 非同期版で待機の方法だけを変えて共用する.
+    """
     if int(timeout) < 0:
       raise ValueError(timeout)
+    if initial_wait < 0:
+      raise ValueError(initial_wait)
+
+    # 測定完了が見込まれるまでまとめて待機
+    initial_wait = min(initial_wait, timeout)
+    if initial_wait > 0:
+      yield initial_wait
 
-    # 100msおきに測定データがあるかチェック
-    for i in range((timeout * 10) + 1):
+    # 残りの時間は100msおきに測定データがあるかチェック
+    polls = round((timeout - initial_wait) * 10)
+    for i in range(polls + 1):
       ready = self.get_data_ready_status()
 
       # 新しいデータがある
@@ -173,22 +293,16 @@ class SCD41:
         break
 
       # タイムアウト
-      if i >= timeout * 10:
+      if i >= polls:
         return False
 
-      time.sleep(0.1)  # 待機
+      yield 0.1  # 待機
 
     # 測定データ読み出し
-    data = self.read_register(0xec05, 9)
-
-    # CRC確認
-    for i in range(3):
-      if self.calculate_crc([data[i * 3], data[i * 3 + 1]]) != data[i * 3 + 2]:
-        raise CRCMismatchError
-
-    self.co2 = (data[0] << 8) + data[1]
-    self.temperature = round(-45 + 175 * ((data[3] << 8) + data[4]) / (2**16), 1)
-    self.humidity = round(100 * ((data[6] << 8) + data[7]) / (2**16), 1)
+    self.co2, temperature_raw, humidity_raw = self._read_words(_CMD_READ_MEASUREMENT, 3)
+    # 小数第1位までの値を整数演算で求める. -45 + 175 * raw / 2**16 を10倍した値.
+    self.temperature = _round_q16(1750 * temperature_raw - (450 << 16)) / 10
+    self.humidity = _round_q16(1000 * humidity_raw) / 10
 
     return True
 
@@ -204,7 +318,7 @@ class SCD41:
     offset_w = round(offset * (2**16) / 175)
     if offset_w > 0xFFFF:  # オフセット値が範囲外
       raise ValueError(offset)
-    self.write_register(0x241d, [offset_w >> 8, offset_w & 0xFF])
+    self.write_register(_CMD_SET_TEMPERATURE_OFFSET, [offset_w >> 8, offset_w & 0xFF])
 
   def get_temperature_offset(self):
     """
@@ -216,14 +330,8 @@ class SCD41:
     Raises:
       CRCMismatchError: CRCが一致しない
     """
-    data = self.read_register(0x2318, 3)
-
-    # CRC確認
-    if self.calculate_crc([data[0], data[1]]) != data[2]:
-      raise CRCMismatchError
-
-    else:
-      return round(175 * ((data[0] << 8) + data[1]) / (2**16), 1)
+    offset_raw, = self._read_words(_CMD_GET_TEMPERATURE_OFFSET, 1)
+    return _round_q16(1750 * offset_raw) / 10
 
   def set_sensor_altitude(self, altitude):
     """
@@ -233,7 +341,7 @@ class SCD41:
     Args:
       altitude (int): 標高[m]の値
     """
-    self.write_register(0x2427, [altitude >> 8, altitude & 0xFF])
+    self.write_register(_CMD_SET_SENSOR_ALTITUDE, [altitude >> 8, altitude & 0xFF])
 
   def get_sensor_altitude(self):
     """
@@ -245,13 +353,8 @@ class SCD41:
     Raises:
       CRCMismatchError: CRCが一致しない
     """
-    data = self.read_register(0x2322, 3)
-
-    # CRC確認
-    if self.calculate_crc([data[0], data[1]]) != data[2]:
-      raise CRCMismatchError
-
-    return (data[0] << 8) + data[1]
+    altitude, = self._read_words(_CMD_GET_SENSOR_ALTITUDE, 1)
+    return altitude
 
   def set_ambient_pressure(self, pressure):
     """
@@ -260,7 +363,7 @@ class SCD41:
     Args:
       pressure: 気圧[hPa]の値
     """
-    self.write_register(0xe000, [pressure >> 8, pressure & 0xFF])
+    self.write_register(_CMD_SET_AMBIENT_PRESSURE, [pressure >> 8, pressure & 0xFF])
 
   def perform_forced_recalibration(self, target=400):
     """
@@ -273,10 +376,39 @@ class SCD41:
     Returns:
       bool: 成功ならTrue. 失敗ならFalse.
     """
-    self.write_register(0x362f, [target >> 8, target & 0xFF])
-    time.sleep(0.5)  # 400ms以上待機
+    deadline = self.start_forced_recalibration(target)
+    return self.finish_forced_recalibration(deadline)
+
+  def start_forced_recalibration(self, target=400):
+    """
+    手動キャリブレーション(FRC)を開始し, 待たずに処理を返す. 
+    結果はfinish_forced_recalibrationで取得する. 完了を待つ間に他の処理を行える.
+
+    Args:
+      target: 既知のCO2濃度[ppm]. 外気で行う場合は400.
+
+    Returns:
+      float: 結果を読み出せるようになる時刻. time.monotonic()の値.
+    """
+    self.write_register(_CMD_PERFORM_FORCED_RECALIBRATION, [target >> 8, target & 0xFF])
+    return time.monotonic() + 0.5  # 400ms以上待機
+
+  def finish_forced_recalibration(self, deadline):
+    """
+    start_forced_recalibrationで開始した手動キャリブレーション(FRC)の結果を読み出す.
+    deadlineの時刻になっていなければ, それまで待機する.
+
+    Args:
+      deadline: start_forced_recalibrationの戻り値
+
+    Returns:
+      bool: 成功ならTrue. 失敗ならFalse.
+    """
+    remaining = deadline - time.monotonic()
+    if remaining > 0:
+      time.sleep(remaining)
 
-    data = self.read_register(0x362f, 3)
+    data = self.read_register(_CMD_PERFORM_FORCED_RECALIBRATION, 3)
 
     if (data[0] == 0xff) and (data[1] == 0xff):
       return False
@@ -299,7 +431,7 @@ class SCD41:
       data = 1
     else:
       data = 0
-    self.write_register(0x2416, [data >> 8, data & 0xff])
+    self.write_register(_CMD_SET_AUTOMATIC_SELF_CALIBRATION_ENABLED, [data >> 8, data & 0xff])
 
   def get_automatic_self_calibration_enabled(self):
     """
@@ -308,7 +440,7 @@ class SCD41:
     Returns:
       bool: 有効ならTrue. 無効ならFalse.
     """
-    data = self.read_register(0x2313, 3)
+    data = self.read_register(_CMD_GET_AUTOMATIC_SELF_CALIBRATION_ENABLED, 3)
 
     if (data[0] << 8) + data[1] == 1:
       return True
@@ -322,7 +454,7 @@ class SCD41:
     Args:
       wait: Trueなら完了までの800ms以上待機する. Falseならすぐに処理を返す.
     """
-    self.write_register(0x3615)
+    self.write_register(_CMD_PERSIST_SETTINGS)
     if wait:
       time.sleep(0.9)
 
@@ -333,7 +465,7 @@ class SCD41:
     Args:
       wait: Trueなら完了までの1200ms以上待機する. Falseならすぐに処理を返す.
     """
-    self.write_register(0x3632)
+    self.write_register(_CMD_PERFORM_FACTORY_RESET)
     if wait:
       time.sleep(1.3)
 
@@ -341,7 +473,7 @@ class SCD41:
     """
     EEPROMの設定を読み出して反映させる.
     """
-    self.write_register(0x3646)
+    self.write_register(_CMD_REINIT)
     time.sleep(0.04)
 
   def get_serial_number(self):
@@ -354,14 +486,8 @@ class SCD41:
     Raises:
       CRCMismatchError: CRCが一致しない
     """
-    data = self.read_register(0x3682, 9)
-
-    # CRC確認
-    for i in range(3):
-      if self.calculate_crc([data[i * 3], data[i * 3 + 1]]) != data[i * 3 + 2]:
-        raise CRCMismatchError
-
-    return ((data[0] << 40) + (data[1] << 32) + (data[2] << 24) + (data[3] << 16) + (data[4] << 8) + data[5])
+    word0, word1, word2 = self._read_words(_CMD_GET_SERIAL_NUMBER, 3)
+    return (word0 << 32) + (word1 << 16) + word2
 
 
 class CRCMismatchError(Exception):
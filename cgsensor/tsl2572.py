@@ -5,7 +5,7 @@ GitHub: https://github.com/IndoorCorgi/cgsensor
 """
 
 import time
-import smbus2
+from ._i2c import get_bus
 
 
 class TSL2572:
@@ -27,9 +27,16 @@ class TSL2572:
   AGAIN_16 = 3  # 16倍
   AGAIN_120 = 4  # 120倍
 
+  # AGAIN_xごとの(Configレジスター(0xD), Controlレジスター(0xF))の設定値と倍率
+  _AGAIN_REGS = ((0x4, 0x0), (0x0, 0x0), (0x0, 0x1), (0x0, 0x2), (0x0, 0x3))
+  _GAIN = (0.16, 1, 8, 16, 120)
+  _GAIN_X100 = (16, 100, 800, 1600, 12000)  # 倍率の100倍. 整数演算用.
+
+  use_integer_math = True  # Trueならcalculate_luxを整数演算で行う. FPUの無い環境で速い.
+
   def __init__(self):
     self.i2c_addr = 0x39
-    self.bus = smbus2.SMBus(1)
+    self.bus = get_bus(1)
     self.adc_ch0 = 0
     self.adc_ch1 = 0
     self.illuminance = 0
@@ -84,6 +91,42 @@ class TSL2572:
       aen (bool): Trueで定期的に測定開始
       wen (bool): Trueで測定間に待機時間を入れる
     """
+    self.write_register(0x0, [self._enable_data(pon, aen, wen)])
+
+  def write_atime(self, integ_cycles):
+    """
+    ALS integration time (測定時間)を書き込む
+
+    Args:
+      integ_cycles (int): 1-256の整数. atime = integ_cycles x 2.73[ms]
+    
+    Raises:
+      ValueError: integ_cyclesが範囲外
+      TypeError: integ_cyclesが整数でない
+    """
+    self.write_register(0x1, [self._atime_data(integ_cycles)])
+
+  def write_enable_atime(self, integ_cycles, pon=False, aen=False, wen=False):
+    """
+    write_enable, write_atimeと同じ内容を1回の転送で書き込む.
+    EnableレジスターとATIMEレジスターはアドレスが連続しているので, 自動インクリメントでまとめて書き込める.
+
+    Args:
+      integ_cycles (int): 1-256の整数. atime = integ_cycles x 2.73[ms]
+      pon (bool): TrueでPower ON
+      aen (bool): Trueで定期的に測定開始
+      wen (bool): Trueで測定間に待機時間を入れる
+
+    Raises:
+      ValueError: integ_cyclesが範囲外
+      TypeError: integ_cyclesが整数でない
+    """
+    self.write_register(0x0, [self._enable_data(pon, aen, wen), self._atime_data(integ_cycles)])
+
+  def _enable_data(self, pon, aen, wen):
+    """
+    Enableレジスターに書き込む値を計算
+    """
     data = 0
     if pon:
       data |= 0x1
@@ -94,27 +137,17 @@ class TSL2572:
     if wen:
       data |= 0x8
 
-    self.write_register(0x0, [data])
+    return data
 
-  def write_atime(self, integ_cycles):
+  def _atime_data(self, integ_cycles):
     """
-    ALS integration time (測定時間)を書き込む
-
-    Args:
-      integ_cycles (int): 1-256の整数. atime = integ_cycles x 2.73[ms]
-    
-    Raises:
-      VallueError: integ_cyclesが整数でないか, 範囲外
+    ATIMEレジスターに書き込む値を計算. integ_cyclesが範囲外ならValueErrorを送出.
     """
-    # 整数でない
-    if not isinstance(integ_cycles, int):
-      raise ValueError(integ_cycles)
-
-    # 範囲外
-    if integ_cycles < 1 or integ_cycles > 256:
+    # 範囲外. 1-256ならinteg_cycles - 1が8bitに収まる
+    if (integ_cycles - 1) & ~0xFF:
       raise ValueError(integ_cycles)
 
-    self.write_register(0x1, [256 - integ_cycles])
+    return 256 - integ_cycles
 
   def write_again(self, again):
     """
@@ -123,21 +156,9 @@ class TSL2572:
     Args:
       again (int): AGAIN_xで指定
     """
-    if self.AGAIN_016 == again:
-      self.write_register(0xD, [0x4])
-      self.write_register(0xF, [0])
-    elif self.AGAIN_1 == again:
-      self.write_register(0xD, [0])
-      self.write_register(0xF, [0])
-    elif self.AGAIN_8 == again:
-      self.write_register(0xD, [0])
-      self.write_register(0xF, [0x1])
-    elif self.AGAIN_16 == again:
-      self.write_register(0xD, [0])
-      self.write_register(0xF, [0x2])
-    elif self.AGAIN_120 == again:
-      self.write_register(0xD, [0])
-      self.write_register(0xF, [0x3])
+    config, control = self._AGAIN_REGS[again]
+    self.write_register(0xD, [config])
+    self.write_register(0xF, [control])
 
   def read_status(self):
     """
@@ -164,11 +185,30 @@ class TSL2572:
     """
     integ_cycles, againの設定で1回測定を行い, adc_ch0, adc_ch1にADCレジスターの値を入れる. 
     """
-    self.write_enable(pon=True, aen=False)  # 一度測定を停止
-    self.write_atime(self.integ_cycles)
+    for wait in self._single_als_integration_steps():
+      time.sleep(wait)
+
+  async def asingle_als_integration(self):
+    """
+    single_als_integrationの非同期版. 測定完了を待つ間はasyncio.sleepで他の処理に制御を渡す.
+    """
+    import asyncio  # 非同期版を使う場合のみ読み込む
+
+    for wait in self._single_als_integration_steps():
+      await asyncio.sleep(wait)
+
+  def _single_als_integration_steps(self):
+    """
+    single_als_integrationの処理本体. 待機が必要な箇所で待機する秒数をyieldする.
+    同期版, 非同期版で待機の方法だけを変えて共用する.
+    """
+    self.write_enable_atime(self.integ_cycles, pon=True, aen=False)  # 一度測定を停止して測定時間を設定
     self.write_again(self.again)
     self.write_enable(pon=True, aen=True)  # 測定開始
 
+    # 測定時間(integ_cycles x 2.73ms)は決まっているので, その間はステータスを確認せずに待つ
+    yield self.integ_cycles * 0.00273 + 0.001
+
     # 結果を待つ
     while True:
       avalid, aint = self.read_status()
@@ -176,7 +216,7 @@ class TSL2572:
         self.write_enable(pon=False, aen=False)  # 測定を停止
         break
       else:
-        time.sleep(0.01)
+        yield 0.002
 
     self.read_adc()
 
@@ -184,24 +224,27 @@ class TSL2572:
     """
     adc_ch0, adc_ch1, integ_cycles, againから照度(明るさ)を計算し, illuminanceに入れる. 
     """
-    t = self.integ_cycles * 2.73
+    if self.use_integer_math:
+      # 係数を100倍した整数で計算する. lux = (100*ch0 - 187*ch1) * 6000 / (integ_cycles * 273 * g*100)
+      num = max(0, 100 * self.adc_ch0 - 187 * self.adc_ch1, 63 * self.adc_ch0 - 100 * self.adc_ch1)
+      if num == 0:
+        self.illuminance = 0
+        return
+
+      # 0.1lux単位に四捨五入
+      num *= 6000 * 10
+      den = self.integ_cycles * 273 * self._GAIN_X100[self.again]
+      self.illuminance = (2 * num + den) // (2 * den) / 10
+      return
 
-    if self.AGAIN_016 == self.again:
-      g = 0.16
-    elif self.AGAIN_1 == self.again:
-      g = 1
-    elif self.AGAIN_8 == self.again:
-      g = 8
-    elif self.AGAIN_16 == self.again:
-      g = 16
-    elif self.AGAIN_120 == self.again:
-      g = 120
+    t = self.integ_cycles * 2.73
+    g = self._GAIN[self.again]
 
     cpl = (t * g) / 60
     lux1 = (self.adc_ch0 - 1.87 * self.adc_ch1) / cpl
     lux2 = (0.63 * self.adc_ch0 - self.adc_ch1) / cpl
 
-    self.illuminance = round(max([0, lux1, lux2]), 1)
+    self.illuminance = round(max(0, lux1, lux2), 1)
 
   def single_auto_measure(self):
     """